@@ -1,23 +1,100 @@
 #!/usr/bin/env python3
  
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass
+from itertools import islice
 import json
-from time import sleep
+import mmap
+import os
+from pathlib import Path
+import stat
+from time import monotonic, sleep
+from typing import Iterator
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
+from urllib3.util import Retry
 
-def login(base_url: str, authenticator: str, username: str, password: str) -> str:
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+DEFAULT_WORKERS = 8
+MAX_MONITOR_SLEEP = 60  # minutes
+SESSION_REFRESH_SECONDS = 600
+PENDING_STATUSES = {"QUEUED", "PAUSED", "PREPARING", "RESTORING"}
+
+
+def check_response(response: requests.Response) -> None:
+    """
+    Args:
+        response (requests.Response): Response to check.
+
+    Raises:
+        RuntimeError: If an error status code is returned.
+    """
+    try:
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        raise RuntimeError(response.text) from e
+
+
+def create_session(max_connections: int) -> requests.Session:
+    """
+    Creates a session whose connections are kept alive and shared by every request,
+    so part submissions running concurrently reuse at most `max_connections`
+    connections rather than opening a new one each time. Transient gateway errors
+    are retried with backoff.
+
+    Args:
+        max_connections (int): Maximum number of connections to keep open.
+
+    Returns:
+        requests.Session: HTTP session to send requests with.
     """
+    session = requests.Session()
+    retry = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=max_connections,
+        pool_block=True,
+        max_retries=retry,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def login(
+    session: requests.Session,
+    base_url: str,
+    authenticator: str,
+    username: str,
+    password: str,
+) -> str:
+    """
+    Logs in to DataGateway and authorizes all further requests made with `session`
+    using the new session id.
+
     Args:
+        session (requests.Session): HTTP session to send requests with.
         base_url (str): URL for DataGateway without path.
         authenticator (str): Authentication mechanism to use.
         username (str): Username to use.
         password (str): Password to use.
 
     Raises:
-        RuntimeError: If a status code other than 200 is returned.
+        RuntimeError: If an error status code is returned.
 
     Returns:
         str: ICAT session id.
@@ -25,24 +102,85 @@ def login(base_url: str, authenticator: str, username: str, password: str) -> st
     url = f"{base_url}/topcat/user/session"
     encoded_password = quote(json.dumps(password)[1:-1])
     data = {"plugin": authenticator, "username": username, "password": encoded_password}
-    response = requests.post(url=url, data=data)
-    if response.status_code != 200:
-        raise RuntimeError(response.text)
+    response = session.post(url=url, data=data)
+    check_response(response)
 
-    return json.loads(response.content)["sessionId"]
+    session_id = loads(response.content)["sessionId"]
+    session.headers.update({"Authorization": f"Bearer {session_id}"})
+    return session_id
+
+
+def read_chunks(input_file: str, chunk_size: int) -> "Iterator[list[str]]":
+    """Memory maps `input_file` and yields its lines in chunks of `chunk_size`.
+    Newlines are located with `mmap.find`, so each chunk is decoded and split on
+    newlines in a single call rather than line by line. A trailing carriage return is
+    removed from each line so CRLF files are also supported. Input that is not a
+    regular file, such as a pipe, is read line by line instead.
+
+    Args:
+        input_file (str):
+            File containing newline delimited filepaths for the requested data.
+        chunk_size (int): Maximum number of lines in each chunk.
+
+    Yields:
+        list[str]: Up to `chunk_size` lines, without line endings.
+    """
+    with open(input_file, "rb", buffering=1 << 20) as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            # Pipes and other streams cannot be memory mapped, so read line by line
+            lines = (line.rstrip(b"\n") for line in f)
+            lines = (line[:-1] if line.endswith(b"\r") else line for line in lines)
+            lines = (line.decode() for line in lines)
+            files = list(islice(lines, chunk_size))
+            while files:
+                yield files
+                files = list(islice(lines, chunk_size))
+            return
+
+        if st.st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            start = 0
+            while start < size:
+                end = start
+                for _ in range(chunk_size):
+                    end = mm.find(b"\n", end) + 1
+                    if end == 0:
+                        end = size
+                        break
+
+                text = mm[start:end].decode()
+                lines = text.split("\n")
+                if text.endswith("\n"):
+                    lines.pop()
+                if "\r" in text:
+                    lines = [
+                        line[:-1] if line.endswith("\r") else line for line in lines
+                    ]
+
+                yield lines
+                start = end
 
 
 def queue_all_files(
+    session: requests.Session,
     base_url: str,
     session_id: str,
     input_file: str,
     transport: str,
     file_name: str,
     email: str,
+    workers: int = DEFAULT_WORKERS,
 ) -> "list[int]":
     """Reads from `file_name` and submits Downloads for every 10,000 listed files.
+    Parts are submitted concurrently using up to `workers` threads, and the file is
+    read as submissions complete so that only a few parts are held in memory at once.
 
     Args:
+        session (requests.Session): HTTP session to send requests with.
         base_url (str): URL for DataGateway without path.
         session_id (str): ICAT session id.
         input_file (str):
@@ -50,48 +188,55 @@ def queue_all_files(
         transport (str): Transport mechanism/access method to use.
         file_name (str): Name used for the Download request (without '_part_N').
         email (str): Optional email to send notifications to.
+        workers (int, optional):
+            Maximum number of parts to submit concurrently. Defaults to
+            DEFAULT_WORKERS.
+
+    Raises:
+        RuntimeError:
+            If an error status code is returned for any part. Parts not yet started
+            are cancelled.
 
     Returns:
         list[int]: List of download ids for each part.
     """
-    i = 1
-    files = []
+    base_file_name = file_name or datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    url = f"{base_url}/topcat/user/queue/files"
     download_ids = []
-    base_file_name = file_name or datetime.now().isoformat()[:19]
-    with open(input_file) as f:
-        line = f.readline()
-        while line:
-            files.append(line.strip())
-            line = f.readline()
-            if len(files) >= 10000:
-                download_id = queue_files(
-                    base_url=base_url,
+    futures = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            chunks = read_chunks(input_file=input_file, chunk_size=10000)
+            for i, files in enumerate(chunks, start=1):
+                if len(futures) >= 2 * workers:
+                    download_ids.append(futures.popleft().result())
+
+                future = executor.submit(
+                    queue_files,
+                    session=session,
+                    url=url,
                     session_id=session_id,
                     files=files,
                     transport=transport,
                     file_name=f"{base_file_name}_part_{i}",
                     email=email,
                 )
-                download_ids.append(download_id)
-                i += 1
-                files = []
-    
-    if files:
-        download_id = queue_files(
-            base_url=base_url,
-            session_id=session_id,
-            files=files,
-            transport=transport,
-            file_name=f"{base_file_name}_part_{i}",
-            email=email,
-        )
-        download_ids.append(download_id)
+                futures.append(future)
+
+            download_ids.extend(future.result() for future in futures)
+        except BaseException:
+            # Stop at the first failed part: submissions already running cannot be
+            # recalled, but those still queued are cancelled
+            for future in futures:
+                future.cancel()
+            raise
 
     return download_ids
 
 
 def queue_files(
-    base_url: str,
+    session: requests.Session,
+    url: str,
     session_id: str,
     files: "list[str]",
     transport: str,
@@ -103,7 +248,8 @@ def queue_files(
     these will be printed to the console.
 
     Args:
-        base_url (str): URL for DataGateway without path.
+        session (requests.Session): HTTP session to send requests with.
+        url (str): URL for the TopCAT queue files endpoint.
         session_id (str): ICAT session id.
         files (list[str]): List of up to 10,000 of the requested filepaths.
         transport (str): Transport mechanism/destination to use.
@@ -114,11 +260,13 @@ def queue_files(
             File containing newline delimited filepaths for the requested data.
 
     Raises:
-        RuntimeError: If a status code other than 200 is returned.
+        RuntimeError: If an error status code is returned.
 
     Returns:
         int: The Download id.
     """
+    # The TopCAT endpoint only consumes form parameters, so files must be sent as
+    # repeated form fields rather than a JSON body or a single joined string
     data = {
         "sessionId": session_id,
         "transport": transport,
@@ -126,11 +274,10 @@ def queue_files(
         "email": email,
         "files": files,
     }
-    response = requests.post(url=base_url + "/topcat/user/queue/files", data=data)
-    if response.status_code != 200:
-        raise RuntimeError(response.text)
+    response = session.post(url=url, data=data)
+    check_response(response)
 
-    content = json.loads(response.content)
+    content = loads(response.content)
     download_id = content["downloadId"]
     not_found = content["notFound"]
     print(
@@ -141,6 +288,7 @@ def queue_files(
 
 
 def monitor(
+    session: requests.Session,
     base_url: str,
     session_id: str,
     downloads: "list[int]",
@@ -148,38 +296,49 @@ def monitor(
 ) -> None:
     """
     Checks the status of all `downloads` and prints this to the console. Will repeat
-    every `monitor_sleep` minutes until all are complete.
+    until all are complete, initially every `monitor_sleep` minutes. The interval
+    doubles each time the statuses are unchanged, up to `MAX_MONITOR_SLEEP` minutes,
+    and resets once any status changes. The ICAT session is refreshed at most every
+    `SESSION_REFRESH_SECONDS`.
 
     Args:
+        session (requests.Session):
+            HTTP session to send requests with, authorized with `session_id`.
+        base_url (str): URL for DataGateway without path.
         session_id (str): ICAT session id.
         downloads (list[int]): List of download ids for each part.
-        monitor_sleep (float): Number of minutes to wait between each check.
+        monitor_sleep (float): Initial number of minutes to wait between checks.
 
     Raises:
-        RuntimeError: If a status code other than 200 is returned.
+        RuntimeError: If an error status code is returned.
     """
-    url = base_url + "/topcat/user/downloads/status"
+    url = f"{base_url}/topcat/user/downloads/status"
+    refresh_url = f"{base_url}/datagateway-api/sessions"
     params = {"sessionId": session_id, "downloadIds": downloads}
-    response = requests.get(url=url, params=params)
-    if response.status_code != 200:
-        raise RuntimeError(response.text)
-    content = json.loads(response.content)
-    print(content)
-
-    while any([s in {"QUEUED", "PAUSED", "PREPARING", "RESTORING"} for s in content]):
-        headers = {"Authorization": f"Bearer {session_id}"}
-        requests.put(url=base_url + "/datagateway-api/sessions", headers=headers)
-        if response.status_code != 200:
-            raise RuntimeError(response.text)
-
-        sleep(monitor_sleep * 60)
-        response = requests.get(url=url, params=params)
-        if response.status_code != 200:
-            raise RuntimeError(response.text)
-
-        content = json.loads(response.content)
+    interval = monitor_sleep
+    last_refresh = monotonic()
+    previous_content = None
+    while True:
+        response = session.get(url=url, params=params)
+        check_response(response)
+
+        content = loads(response.content)
         print(content)
-    
+        if not any(status in PENDING_STATUSES for status in content):
+            break
+
+        if content == previous_content:
+            interval = max(monitor_sleep, min(interval * 2, MAX_MONITOR_SLEEP))
+        else:
+            interval = monitor_sleep
+        previous_content = content
+
+        sleep(interval * 60)
+        if monotonic() - last_refresh > SESSION_REFRESH_SECONDS:
+            refresh_response = session.put(url=refresh_url)
+            check_response(refresh_response)
+            last_refresh = monotonic()
+
     print("All downloads complete")
 
 
@@ -270,34 +429,50 @@ if __name__ == "__main__":
         default=0,
         help=(
             "Monitor the submitted downloads to see if they are complete with an "
-            "interval of this many minutes. Non-positive values will disable "
+            "initial interval of this many minutes. The interval doubles (up to 60 "
+            "minutes) while statuses are unchanged. Non-positive values will disable "
             "monitoring."
         ),
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="The maximum number of part Downloads to submit concurrently.",
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("argument -w/--workers: must be at least 1")
 
     if args.password_file is None:
         password = getpass()
     else:
-        with open(args.password_file) as f:
-            password = f.readline().strip()
+        lines = Path(args.password_file).read_text().splitlines()
+        password = lines[0] if lines else ""
+
+    session = create_session(max_connections=args.workers)
 
     session_id = login(
+        session=session,
         base_url=args.url,
         authenticator=args.authenticator,
         username=args.username,
         password=password,
     )
     download_ids = queue_all_files(
+        session=session,
         base_url=args.url,
         session_id=session_id,
         input_file=args.input_file,
         transport=args.access_method,
         file_name=args.download_name,
         email=args.email_address,
+        workers=args.workers,
     )
     if args.monitor_interval > 0:
         monitor(
+            session=session,
             base_url=args.url,
             session_id=session_id,
             downloads=download_ids,